@@ -0,0 +1,10 @@
+# numba's njit when it is installed (it is optional), otherwise a no-op
+# decorator so the same kernels run as plain Python.
+
+try:
+    from numba import njit
+except ImportError:
+    def njit(*args, **kwargs):
+        if len(args) == 1 and callable(args[0]) and not kwargs:
+            return args[0]
+        return lambda f: f
@@ -0,0 +1,19 @@
+# Fastest JSON codec available: orjson, then ujson, then the stdlib json.
+# loads takes str or bytes, dumps always returns str.
+
+try:
+    import orjson
+
+    loads = orjson.loads
+
+    def dumps(obj):
+        return orjson.dumps(obj).decode()
+
+except ImportError:
+    try:
+        import ujson as codec
+    except ImportError:
+        import json as codec
+
+    loads = codec.loads
+    dumps = codec.dumps
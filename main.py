@@ -1,6 +1,19 @@
+import heapq
 import os
+import queue
+import random
+import threading
 import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+import json_codec
+from jit import njit
 
 # ================= CONFIG =================
 
@@ -14,6 +27,12 @@ PRODUCTS = ["BTC-PERP-INTX", "ETH-PERP-INTX"]
 TREND_GRANULARITY = "ONE_HOUR"
 ENTRY_GRANULARITY = "FIVE_MINUTE"
 
+GRANULARITY_SECONDS = {"FIVE_MINUTE": 300, "ONE_HOUR": 3600}
+CANDLE_HISTORY = 300
+CANDLE_FRESH = 10
+
+TREND_TTL = 300
+
 TREND_FAST_MA = 50
 TREND_SLOW_MA = 200
 
@@ -31,78 +50,259 @@ TRADE_SIZE = 100
 MAX_OPEN_TRADES = 1
 
 SCAN_INTERVAL = 30
+FETCH_WORKERS = 10
+COINBASE_MAX_RPS = 8
 UPDATE_INTERVAL = 180
+MAX_BACKOFF = 300
 
 START_BALANCE = 500.0
 
+STATE_FILE = os.getenv("STATE_FILE", "state.json")
+
+USER_AGENT = "futures-trend-bot/1.0"
+
+TELEGRAM_MAX_CHARS = 4096
+TELEGRAM_RETRIES = 3
+ALERT_SEPARATOR = "\n\n────────\n\n"
+
+POSITION_STATUS_TPL = (
+    "\n"
+    "{product} | {side}\n"
+    "Entry: {entry:.2f}\n"
+    "Current: {price:.2f}\n"
+    "PnL: ${pnl_usd:.2f} ({pnl_pct:.2f}%)\n"
+    "Peak: {peak:.2f}\n"
+    "Trail Distance: {trail_dist:.2f}%"
+)
+
+EMPTY_CANDLES = np.empty((0, 6))
+
 # ================= STATE =================
 
 balance = START_BALANCE
 positions = {}
+trend_cache = {}
+candle_cache = {}
+candle_fetched = {}
 running = True
-last_update = 0
 telegram_offset = None
+saved_state = None
+telegram_queue = queue.Queue()
+executor = ThreadPoolExecutor(max_workers=FETCH_WORKERS)
+coinbase_calls = deque()
+coinbase_lock = threading.Lock()
+
+session = requests.Session()
+session.headers.update({"User-Agent": USER_AGENT, "Accept": "application/json"})
+session.mount("https://", HTTPAdapter(
+    pool_connections=32,
+    pool_maxsize=32,
+    max_retries=Retry(total=3, backoff_factor=0.3, status_forcelist=[429, 500, 502, 503, 504])
+))
 
 # ================= HELPERS =================
 
 def send_telegram(msg):
     if not TELEGRAM_TOKEN or not CHAT_ID:
         return
+    telegram_queue.put(msg)
+
+def telegram_worker():
+    while True:
+        msgs = [telegram_queue.get()]
+        while not telegram_queue.empty():
+            msgs.append(telegram_queue.get_nowait())
+
+        for text in pack_messages(msgs):
+            post_telegram(text)
+
+def post_telegram(text):
+    delay = 1
+    for attempt in range(TELEGRAM_RETRIES):
+        try:
+            r = session.post(
+                f"https://api.telegram.org/bot{TELEGRAM_TOKEN}/sendMessage",
+                json={"chat_id": CHAT_ID, "text": text},
+                timeout=10
+            )
+            if r.status_code == 429:
+                delay = json_codec.loads(r.content).get("parameters", {}).get("retry_after", delay)
+            elif r.status_code < 500:
+                return
+        except:
+            pass
+
+        if attempt < TELEGRAM_RETRIES - 1:
+            time.sleep(delay)
+            delay *= 2
+
+def pack_messages(msgs):
+    chunks = []
+    chunk = ""
+    for msg in msgs:
+        if chunk and len(chunk) + len(ALERT_SEPARATOR) + len(msg) > TELEGRAM_MAX_CHARS:
+            chunks.append(chunk)
+            chunk = ""
+        chunk = chunk + ALERT_SEPARATOR + msg if chunk else msg
+
+        while len(chunk) > TELEGRAM_MAX_CHARS:
+            chunks.append(chunk[:TELEGRAM_MAX_CHARS])
+            chunk = chunk[TELEGRAM_MAX_CHARS:]
+
+    if chunk:
+        chunks.append(chunk)
+
+    return chunks
+
+def load_state():
+    global balance, telegram_offset, saved_state
     try:
-        requests.post(
-            f"https://api.telegram.org/bot{TELEGRAM_TOKEN}/sendMessage",
-            json={"chat_id": CHAT_ID, "text": msg}
-        )
+        with open(STATE_FILE, "rb") as f:
+            data = f.read()
+        state = json_codec.loads(data)
+    except:
+        return
+
+    if not isinstance(state, dict):
+        return
+
+    balance = state.get("balance", START_BALANCE)
+    positions.update(state.get("positions", {}))
+    telegram_offset = state.get("telegram_offset")
+    saved_state = data.decode()
+
+def save_state():
+    global saved_state
+    state = json_codec.dumps({
+        "balance": balance,
+        "positions": positions,
+        "telegram_offset": telegram_offset
+    })
+    if state == saved_state:
+        return
+
+    tmp = STATE_FILE + ".tmp"
+    try:
+        with open(tmp, "w") as f:
+            f.write(state)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, STATE_FILE)
+        saved_state = state
     except:
         pass
 
+def rate_limit():
+    with coinbase_lock:
+        now = time.monotonic()
+        while coinbase_calls and now - coinbase_calls[0] >= 1:
+            coinbase_calls.popleft()
+
+        if len(coinbase_calls) >= COINBASE_MAX_RPS:
+            time.sleep(1 - (now - coinbase_calls[0]))
+            coinbase_calls.popleft()
+
+        coinbase_calls.append(time.monotonic())
+
+def http_get_json(url, params=None, timeout=10):
+    r = session.get(url, params=params, timeout=timeout)
+    return json_codec.loads(r.content)
+
+def iso_time(ts):
+    return time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime(ts))
+
 def get_candles(product, granularity, limit=200):
     try:
         url = f"https://api.exchange.coinbase.com/products/{product.replace('-PERP-INTX','-USD')}/candles"
-        params = {"granularity": 300 if granularity=="FIVE_MINUTE" else 3600}
-        r = requests.get(url, params=params, timeout=10)
-        data = r.json()
-        return list(reversed(data))[-limit:]
+        seconds = GRANULARITY_SECONDS[granularity]
+        params = {"granularity": seconds}
+
+        key = (product, granularity)
+        cached = candle_cache.get(key)
+        now = time.time()
+
+        if cached is not None and len(cached) and now - candle_fetched.get(key, 0) < CANDLE_FRESH:
+            return cached[-limit:]
+
+        incremental = cached is not None and len(cached) and now - cached[-1, 0] < CANDLE_HISTORY * seconds
+        if incremental:
+            params["start"] = iso_time(cached[-1, 0])
+            params["end"] = iso_time(now)
+
+        rate_limit()
+        data = http_get_json(url, params)
+        # rows are [time, low, high, open, close, volume], newest first
+        candles = np.array(data, dtype=np.float64).reshape(-1, 6)[::-1]
+
+        if incremental:
+            if not len(candles):
+                candle_fetched[key] = now
+                return cached[-limit:]
+            # the last cached bar may have been partial, so the fresh copy replaces it
+            candles = np.concatenate([cached[cached[:, 0] < candles[0, 0]], candles])
+
+        # never cache an empty history, or the series would stop refreshing
+        if not len(candles):
+            return EMPTY_CANDLES
+
+        candles = candles[-CANDLE_HISTORY:]
+        candle_cache[key] = candles
+        candle_fetched[key] = now
+        return candles[-limit:]
     except:
-        return []
+        return EMPTY_CANDLES
 
 def calc_ma(prices, period):
     if len(prices) < period:
         return None
-    return sum(prices[-period:]) / period
+    return prices[-period:].mean()
+
+@njit(cache=True, fastmath=True)
+def rsi_kernel(prices, period):
+    n = len(prices)
+    gain = 0.0
+    loss = 0.0
+    for i in range(n - period, n):
+        diff = prices[i] - prices[i - 1]
+        if diff > 0:
+            gain += diff
+        else:
+            loss -= diff
+    return gain / period, loss / period
 
 def calc_rsi(prices, period=14):
     if len(prices) < period+1:
         return None
-    gains = []
-    losses = []
-    for i in range(-period, 0):
-        diff = prices[i] - prices[i-1]
-        if diff >= 0:
-            gains.append(diff)
-        else:
-            losses.append(abs(diff))
-    avg_gain = sum(gains)/period if gains else 0
-    avg_loss = sum(losses)/period if losses else 0
+    avg_gain, avg_loss = rsi_kernel(prices, period)
     if avg_loss == 0:
         return 100
     rs = avg_gain / avg_loss
     return 100 - (100 / (1 + rs))
 
 def get_price(candle):
-    return candle[4]
+    return float(candle[4])
+
+def get_last_prices(products):
+    results = executor.map(lambda p: get_candles(p, ENTRY_GRANULARITY, 2), products)
+
+    prices = {}
+    for product, candles in zip(products, results):
+        if len(candles):
+            prices[product] = get_price(candles[-1])
+
+    return prices
 
 # ================= STATUS BUILDER =================
 
 def build_status():
     lines = [f"📊 Balance: ${balance:.2f}", f"Open Trades: {len(positions)}"]
+    prices = get_last_prices(list(positions))
 
     for product, pos in positions.items():
-        candles = get_candles(product, ENTRY_GRANULARITY, 2)
-        if not candles:
+        if product not in prices:
             continue
 
-        price = get_price(candles[-1])
+        price = prices[product]
         entry = pos["entry"]
         side = pos["side"]
         size = pos["size"]
@@ -117,13 +317,10 @@ def build_status():
         else:
             trail_dist = ((price - peak) / peak) * 100
 
-        lines.append("")
-        lines.append(f"{product} | {side}")
-        lines.append(f"Entry: {entry:.2f}")
-        lines.append(f"Current: {price:.2f}")
-        lines.append(f"PnL: ${pnl_usd:.2f} ({pnl_pct:.2f}%)")
-        lines.append(f"Peak: {peak:.2f}")
-        lines.append(f"Trail Distance: {trail_dist:.2f}%")
+        lines.append(POSITION_STATUS_TPL.format(
+            product=product, side=side, entry=entry, price=price,
+            pnl_usd=pnl_usd, pnl_pct=pnl_pct, peak=peak, trail_dist=trail_dist
+        ))
 
     return "\n".join(lines)
 
@@ -139,7 +336,7 @@ def handle_telegram():
         if telegram_offset:
             params["offset"] = telegram_offset
 
-        r = requests.get(url, params=params, timeout=5).json()
+        r = http_get_json(url, params, timeout=5)
 
         for update in r.get("result", []):
             telegram_offset = update["update_id"] + 1
@@ -162,9 +359,19 @@ def handle_telegram():
 # ================= CORE =================
 
 def detect_trend(product):
+    cached = trend_cache.get(product)
+    if cached and time.time() - cached["ts"] < TREND_TTL:
+        return cached["trend"]
+
     candles = get_candles(product, TREND_GRANULARITY)
-    closes = [get_price(c) for c in candles]
+    if not len(candles):
+        return "NONE"
 
+    trend = calc_trend(candles[:, 4])
+    trend_cache[product] = {"ts": time.time(), "trend": trend}
+    return trend
+
+def calc_trend(closes):
     ma_fast = calc_ma(closes, TREND_FAST_MA)
     ma_slow = calc_ma(closes, TREND_SLOW_MA)
 
@@ -181,10 +388,7 @@ def detect_trend(product):
 
     return "NONE"
 
-def check_entry(product, trend):
-    candles = get_candles(product, ENTRY_GRANULARITY)
-    closes = [get_price(c) for c in candles]
-
+def check_entry(closes, trend):
     ma = calc_ma(closes, ENTRY_FAST_MA)
     rsi = calc_rsi(closes)
 
@@ -201,6 +405,35 @@ def check_entry(product, trend):
 
     return None
 
+def scan_product(product):
+    trend = detect_trend(product)
+    if trend == "NONE":
+        return None
+
+    candles = get_candles(product, ENTRY_GRANULARITY)
+    if not len(candles):
+        return None
+
+    closes = candles[:, 4]
+    signal = check_entry(closes, trend)
+    if not signal:
+        return None
+
+    return signal, get_price(candles[-1])
+
+def scan_products():
+    if len(positions) >= MAX_OPEN_TRADES:
+        return
+
+    candidates = [p for p in PRODUCTS if p not in positions]
+
+    entries = executor.map(scan_product, candidates)
+
+    for product, entry in zip(candidates, entries):
+        if entry:
+            signal, price = entry
+            open_position(product, signal, price)
+
 def open_position(product, side, price):
     if len(positions) >= MAX_OPEN_TRADES:
         return
@@ -219,12 +452,9 @@ def open_position(product, side, price):
 def manage_positions():
     global balance
 
-    for product in list(positions.keys()):
-        candles = get_candles(product, ENTRY_GRANULARITY, 2)
-        if not candles:
-            continue
+    prices = get_last_prices(list(positions))
 
-        price = get_price(candles[-1])
+    for product, price in prices.items():
         pos = positions[product]
 
         entry = pos["entry"]
@@ -262,32 +492,52 @@ def close_position(product, price, reason):
 
 # ================= MAIN =================
 
-send_telegram("🚀 Futures Trend Bot Started (PAPER MODE)")
-
-while True:
-    handle_telegram()
-
+def run_scan():
     if running:
-        for product in PRODUCTS:
-            if product in positions:
-                continue
+        scan_products()
+        manage_positions()
 
-            trend = detect_trend(product)
-            if trend == "NONE":
-                continue
+def send_status():
+    send_telegram(build_status())
 
-            signal = check_entry(product, trend)
+def main():
+    load_state()
+    threading.Thread(target=telegram_worker, daemon=True).start()
 
-            if signal:
-                candles = get_candles(product, ENTRY_GRANULARITY, 1)
-                if candles:
-                    price = get_price(candles[-1])
-                    open_position(product, signal, price)
+    send_telegram("🚀 Futures Trend Bot Started (PAPER MODE)")
 
-        manage_positions()
+    intervals = {
+        handle_telegram: SCAN_INTERVAL,
+        run_scan: SCAN_INTERVAL,
+        save_state: SCAN_INTERVAL,
+        send_status: UPDATE_INTERVAL,
+    }
 
-    if time.time() - last_update > UPDATE_INTERVAL:
-        last_update = time.time()
-        send_telegram(build_status())
+    # (next run, order, task); order breaks ties so tasks due together keep this sequence
+    now = time.monotonic()
+    schedule = [(now, order, task) for order, task in enumerate(intervals)]
+    heapq.heapify(schedule)
+    failures = dict.fromkeys(intervals, 0)
 
-    time.sleep(SCAN_INTERVAL)
+    try:
+        while True:
+            next_run, order, task = heapq.heappop(schedule)
+            time.sleep(max(0, next_run - time.monotonic()))
+
+            try:
+                task()
+                failures[task] = 0
+                next_run += intervals[task]
+                while next_run <= time.monotonic():
+                    next_run += intervals[task]
+            except Exception:
+                failures[task] += 1
+                backoff = min(MAX_BACKOFF, intervals[task] * 2 ** (failures[task] - 1))
+                next_run = time.monotonic() + max(intervals[task], backoff) + random.random()
+
+            heapq.heappush(schedule, (next_run, order, task))
+    finally:
+        save_state()
+
+if __name__ == "__main__":
+    main()